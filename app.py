@@ -6,6 +6,8 @@ import os
 import glob
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
+from scipy import sparse
+from scipy.spatial import cKDTree
 import re
 import io
 import pathlib
@@ -13,11 +15,19 @@ import zipfile
 import argparse
 import unicodedata
 import json
+import hashlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
 try:
     import tabulate  # noqa
     HAS_TABULATE = True
 except Exception:
     HAS_TABULATE = False
+try:
+    import resource
+    HAS_RESOURCE = True
+except Exception:
+    HAS_RESOURCE = False
 def _to_md(df):
     return df.to_markdown(index=False) if HAS_TABULATE else df.to_string(index=False)
 
@@ -52,6 +62,17 @@ CINE_STEM_AREAS = {
     '06': 'Tecnologias da Informação e Comunicação (TIC)',
     '07': 'Engenharia, Produção e Construção'
 }
+# Hierarquia CINE Brasil (do mais fino ao mais geral): nível, coluna de código, coluna de nome, largura do código
+CINE_NIVEIS = [
+    ('rotulo', 'CO_CINE_ROTULO', 'NO_CINE_ROTULO', None),
+    ('detalhada', 'CO_CINE_AREA_DETALHADA', 'NO_CINE_AREA_DETALHADA', 4),
+    ('especifica', 'CO_CINE_AREA_ESPECIFICA', 'NO_CINE_AREA_ESPECIFICA', 3),
+    ('geral', 'CO_CINE_AREA_GERAL', 'NO_CINE_AREA_GERAL', 2),
+]
+CINE_COLS_DETALHE = [
+    'CO_CINE_ROTULO', 'NO_CINE_ROTULO', 'CO_CINE_AREA_DETALHADA', 'NO_CINE_AREA_DETALHADA',
+    'CO_CINE_AREA_ESPECIFICA', 'NO_CINE_AREA_ESPECIFICA'
+]
 
 # --- 2. FUNÇÕES DE CARREGAMENTO E PRÉ-PROCESSAMENTO ---
 
@@ -110,20 +131,147 @@ def identificar_stem(texto):
     ]
     return any(p in texto for p in palavras_chave)
 
+def _cine_codigo(s, largura=None):
+    """Normaliza códigos CINE (lidos como número ou texto) em categórico com zeros à esquerda."""
+    uniq = pd.Series(s.dropna().unique())
+    if uniq.empty:
+        return s.astype('category')
+    txt = uniq.astype(str).str.strip().str.upper().str.replace(r'\.0$', '', regex=True)
+    if largura:
+        txt = txt.str.zfill(largura)
+    return s.map(dict(zip(uniq, txt))).astype('category')
+
+def _mascara_stem(df):
+    """Linhas STEM: código CINE geral quando preenchido, palavras-chave da área como respaldo."""
+    col_area = next((c for c in ['AREA_GERAL', 'NO_CINE_AREA_GERAL', 'NO_OCDE_AREA_GERAL'] if c in df.columns), None)
+    if col_area:
+        area = df[col_area].astype('object')
+        por_area = area.map({v: identificar_stem(v) for v in area.dropna().unique()}).fillna(False).astype(bool)
+    else:
+        por_area = pd.Series(False, index=df.index)
+    if 'CO_CINE_AREA_GERAL' not in df.columns:
+        return por_area
+    cod = _cine_codigo(df['CO_CINE_AREA_GERAL'], 2)
+    return pd.Series(np.where(cod.notna(), cod.isin(CINE_STEM_CODES), por_area), index=df.index)
+
+# Modo de memória limitada (--memoria-max)
+MEMORIA_FRACAO_CHUNK = 0.25  # parte da folga de memória destinada a cada chunk lido
+MEMORIA_PARTICOES = 16  # partições por hash na reagregação dos chunks de um ano
+MEMORIA_CHUNKS = {}
+
+def _parse_memoria(txt):
+    """Converte '2G', '1.5GB', '800M' ou '800' (MB) em bytes."""
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', str(txt).upper())
+    if not m:
+        return None
+    return int(float(m.group(1)) * 1024 ** {'K': 1, '': 2, 'M': 2, 'G': 3, 'T': 4}[m.group(2)])
+
+def _rss_pico():
+    """Pico de memória residente do processo em bytes (0 se indisponível na plataforma)."""
+    if not HAS_RESOURCE:
+        return 0
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform == 'darwin' else r * 1024
+
+def _rss_atual():
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return _rss_pico()
+
+def _chunk_size_auto(path_csv, usecols, dtypes, sep=';'):
+    """Linhas por chunk a partir do tamanho do arquivo e da folga no orçamento de memória."""
+    amostra = pd.read_csv(path_csv, sep=sep, encoding='latin1', low_memory=False, nrows=5000, usecols=usecols, dtype=dtypes)
+    if amostra.empty:
+        return 10_000
+    bytes_mem = amostra.memory_usage(deep=True).sum() / len(amostra)
+    with open(path_csv, 'rb') as fh:
+        inicio = fh.read(1 << 20)
+    bytes_disco = len(inicio) / max(inicio.count(b'\n'), 1)
+    linhas_est = int(os.path.getsize(path_csv) / bytes_disco) + 1
+    folga = max(MEMORIA_MAX - _rss_atual(), MEMORIA_MAX * 0.1)
+    # O tokenizador guarda todos os campos da linha bruta (mesmo fora de usecols) e o chunk passa por
+    # cópias de filtro/conversão: ~4x (bytes no disco + bytes em memória) por linha
+    linhas = int(folga * MEMORIA_FRACAO_CHUNK / (4 * (bytes_disco + bytes_mem)))
+    return max(1_000, min(linhas, linhas_est))
+
+# Regras de qualidade avaliadas por chunk durante a carga (contagens e amostras acumuladas)
+QUALIDADE_CONTAGENS = []
+QUALIDADE_AMOSTRAS = []
+_QUALIDADE_N_AMOSTRA = {}
+
+def _validar_chunk(ch, ano, arquivo):
+    """Avalia as regras de qualidade no chunk e devolve a máscara de linhas a manter.
+
+    Com a política 'manter' todas as linhas seguem; com 'quarentena' as que violam alguma regra
+    são descartadas. Até QUALIDADE_AMOSTRA linhas por ano, arquivo e regra vão para a amostra.
+    """
+    mat = pd.to_numeric(ch['QT_MAT'], errors='coerce') if 'QT_MAT' in ch.columns else pd.Series(np.nan, index=ch.index)
+    fem = pd.to_numeric(ch['QT_MAT_FEM'], errors='coerce') if 'QT_MAT_FEM' in ch.columns else pd.Series(np.nan, index=ch.index)
+    regiao = ch['NO_REGIAO'] if 'NO_REGIAO' in ch.columns else pd.Series(np.nan, index=ch.index)
+    regras = {
+        'QT_AUSENTE': mat.isna() | fem.isna(),
+        'QT_NEGATIVA': (mat < 0) | (fem < 0),
+        'FEM_MAIOR_QUE_MAT': fem > mat,
+        'REGIAO_DESCONHECIDA': ~regiao.isin(set(REGIAO_UF.values())),
+    }
+    if 'CO_CINE_AREA_GERAL' in ch.columns:
+        cine = pd.to_numeric(ch['CO_CINE_AREA_GERAL'], errors='coerce')
+        # CINE Brasil: áreas gerais 00 a 10; código preenchido fora disso (ou não numérico) é desconhecido
+        regras['CINE_DESCONHECIDO'] = ch['CO_CINE_AREA_GERAL'].notna() & ~cine.between(0, 10)
+    violacao = pd.Series(False, index=ch.index)
+    for regra, m in regras.items():
+        n = int(m.sum())
+        QUALIDADE_CONTAGENS.append({'ANO': ano, 'ARQUIVO': arquivo, 'REGRA': regra, 'LINHAS': len(ch), 'OCORRENCIAS': n})
+        if n == 0:
+            continue
+        violacao |= m
+        chave = (ano, arquivo, regra)
+        resta = QUALIDADE_AMOSTRA - _QUALIDADE_N_AMOSTRA.get(chave, 0)
+        if resta > 0:
+            amostra = ch[m].head(resta).copy()
+            amostra.insert(0, 'REGRA', regra)
+            amostra.insert(0, 'ARQUIVO', arquivo)
+            amostra.insert(0, 'ANO', ano)
+            QUALIDADE_AMOSTRAS.append(amostra)
+            _QUALIDADE_N_AMOSTRA[chave] = _QUALIDADE_N_AMOSTRA.get(chave, 0) + len(amostra)
+    if QUALIDADE_POLITICA == 'quarentena':
+        return ~violacao
+    return pd.Series(True, index=ch.index)
+
 def load_cursos(ano):
     """Carrega e pré-processa os dados de cursos para um dado ano."""
     try:
         path_csv = CSV_BY_YEAR.get(ano, None)
         if path_csv is not None:
-            if args.chunk_size and args.chunk_size > 0:
-                cols_base = [
-                    'NO_REGIAO','SG_UF','NO_MUNICIPIO','CO_MUNICIPIO','TP_CATEGORIA_ADMINISTRATIVA',
-                    'NO_CINE_AREA_GERAL','NO_OCDE_AREA_GERAL','CO_CINE_AREA_GERAL',
-                    'QT_MAT','QT_MAT_FEM','QT_ING','QT_CONC','CO_IES'
-                ]
+            cols_base = [
+                'NO_REGIAO','SG_UF','NO_MUNICIPIO','CO_MUNICIPIO','TP_CATEGORIA_ADMINISTRATIVA',
+                'NO_CINE_AREA_GERAL','NO_OCDE_AREA_GERAL','CO_CINE_AREA_GERAL',
+                'QT_MAT','QT_MAT_FEM','QT_ING','QT_CONC','CO_IES'
+            ] + CINE_COLS_DETALHE
+            # Com orçamento de memória só as colunas usadas são lidas (CO_UF permite inferir a região;
+            # QT_ING/QT_CONC não entram em nenhuma análise)
+            usecols = (lambda c: (c in cols_base and c not in ('QT_ING', 'QT_CONC')) or c == 'CO_UF') if MEMORIA_MAX else None
+            # Colunas de texto lidas direto como categóricas: o parser não cria um objeto str por linha
+            dtypes = {c: 'category' for c in cols_base if c.startswith(('NO_', 'SG_', 'CO_CINE_A', 'CO_CINE_R')) and c != 'CO_CINE_AREA_GERAL'} if MEMORIA_MAX else None
+            chunk_size = args.chunk_size if args.chunk_size and args.chunk_size > 0 else 0
+            if MEMORIA_MAX and not chunk_size:
+                chunk_size = _chunk_size_auto(path_csv, usecols, dtypes)
+            if chunk_size:
+                MEMORIA_CHUNKS[ano] = chunk_size
                 agg_df = None
-                for chunk in pd.read_csv(path_csv, sep=';', encoding='latin1', low_memory=False, chunksize=args.chunk_size):
+                dicionarios = {}
+                particoes = [[] for _ in range(MEMORIA_PARTICOES)]
+                for chunk in pd.read_csv(path_csv, sep=';', encoding='latin1', low_memory=False, chunksize=chunk_size, usecols=usecols, dtype=dtypes):
                     chunk = infer_regiao_uf(chunk)
+                    manter = _validar_chunk(chunk, ano, os.path.basename(path_csv))
+                    if MEMORIA_MAX:
+                        # Descarta cedo o que a análise não usa: fora das regiões alvo ou não STEM
+                        manter &= chunk['NO_REGIAO'].isin(REGIOES_ALVO) & _mascara_stem(chunk)
+                        if CINE_CODES_SELECTED and 'CO_CINE_AREA_GERAL' in chunk.columns:
+                            manter &= _cine_codigo(chunk['CO_CINE_AREA_GERAL'], 2).isin(CINE_CODES_SELECTED)
+                    chunk = chunk[manter]
                     cols_present = [c for c in cols_base if c in chunk.columns]
                     ch = chunk[cols_present].copy()
                     col_area = 'NO_CINE_AREA_GERAL' if 'NO_CINE_AREA_GERAL' in ch.columns else ('NO_OCDE_AREA_GERAL' if 'NO_OCDE_AREA_GERAL' in ch.columns else None)
@@ -134,40 +282,74 @@ def load_cursos(ano):
                     for c in ['QT_MAT','QT_MAT_FEM','QT_ING','QT_CONC']:
                         if c in ch.columns:
                             ch[c] = pd.to_numeric(ch[c], errors='coerce')
-                    keys = ['NO_REGIAO','SG_UF','NO_MUNICIPIO','CO_MUNICIPIO','TP_CATEGORIA_ADMINISTRATIVA','AREA_GERAL','CO_CINE_AREA_GERAL','CO_IES']
+                    keys = ['NO_REGIAO','SG_UF','NO_MUNICIPIO','CO_MUNICIPIO','TP_CATEGORIA_ADMINISTRATIVA','AREA_GERAL','CO_CINE_AREA_GERAL','CO_IES'] + CINE_COLS_DETALHE
                     keys = [k for k in keys if k in ch.columns]
                     sums = {}
                     for c in ['QT_MAT','QT_MAT_FEM','QT_ING','QT_CONC']:
                         if c in ch.columns:
                             sums[c] = ('%s'%c,'sum')
-                    grp = ch.groupby(keys).agg(**sums).reset_index() if sums else ch
-                    if agg_df is None:
+                    if MEMORIA_MAX:
+                        # Chaves de texto viram códigos int32 de um dicionário do ano (decodificados ao final)
+                        for k in keys:
+                            if k in ('CO_MUNICIPIO', 'TP_CATEGORIA_ADMINISTRATIVA', 'CO_CINE_AREA_GERAL', 'CO_IES'):
+                                if pd.api.types.is_integer_dtype(ch[k]):
+                                    ch[k] = pd.to_numeric(ch[k], downcast='integer')
+                                continue
+                            dic = dicionarios.setdefault(k, {})
+                            col = ch[k] if isinstance(ch[k].dtype, pd.CategoricalDtype) else ch[k].astype('category')
+                            cats = col.cat.categories
+                            novos = [v for v in cats if v not in dic]
+                            dic.update(zip(novos, range(len(dic), len(dic) + len(novos))))
+                            mapa = np.append(np.array([dic[v] for v in cats], dtype=np.int32), np.int32(-1))
+                            ch[k] = mapa[col.cat.codes.to_numpy()]
+                    grp = ch.groupby(keys, dropna=False).agg(**sums).reset_index() if sums else ch
+                    if MEMORIA_MAX and sums:
+                        # Partições por hash das chaves: um grupo nunca fica em duas partições, então cada
+                        # uma é reagregada sozinha e o custo do groupby fica limitado a 1/MEMORIA_PARTICOES
+                        part = pd.util.hash_pandas_object(grp[keys], index=False).to_numpy() % MEMORIA_PARTICOES
+                        for i in np.unique(part):
+                            particoes[i].append(grp[part == i])
+                            if len(particoes[i]) > 8:
+                                particoes[i] = [pd.concat(particoes[i], ignore_index=True).groupby(keys, dropna=False).agg(**sums).reset_index()]
+                    elif agg_df is None:
                         agg_df = grp
                     else:
                         agg_df = pd.concat([agg_df, grp], ignore_index=True)
-                        agg_df = agg_df.groupby(keys).agg(**sums).reset_index() if sums else agg_df
+                        agg_df = agg_df.groupby(keys, dropna=False).agg(**sums).reset_index() if sums else agg_df
+                if any(particoes):
+                    agregadas = []
+                    for i, p in enumerate(particoes):
+                        if p:
+                            agregadas.append(pd.concat(p, ignore_index=True).groupby(keys, dropna=False).agg(**sums).reset_index())
+                            particoes[i] = None
+                    agg_df = pd.concat(agregadas, ignore_index=True)
+                    del agregadas
                 if agg_df is None:
                     df = pd.DataFrame()
                 else:
                     df = agg_df
+                    for k, dic in dicionarios.items():
+                        df[k] = pd.Categorical.from_codes(df[k].to_numpy(), categories=pd.Index(list(dic), dtype=object))
                 df['QT_MAT'] = df['QT_MAT'] if 'QT_MAT' in df.columns else df.get('QT_MAT_FEM', 0)
             else:
                 df = pd.read_csv(path_csv, sep=';', encoding='latin1', low_memory=False)
                 df = infer_regiao_uf(df)
+                df = df[_validar_chunk(df, ano, os.path.basename(path_csv))]
         else:
-            df = pd.DataFrame()
+            # Anos só com GRADUACAO_*.CSV (1995–2008)
+            return load_legacy_cursos(ano)
         
         df = df[df['NO_REGIAO'].isin(REGIOES_ALVO)].copy()
         
         # Identifica a coluna de área geral
-        col_area = 'NO_CINE_AREA_GERAL' if 'NO_CINE_AREA_GERAL' in df.columns else 'NO_OCDE_AREA_GERAL'
+        col_area = next((c for c in ['NO_CINE_AREA_GERAL', 'NO_OCDE_AREA_GERAL', 'AREA_GERAL'] if c in df.columns), 'NO_OCDE_AREA_GERAL')
         
         # Colunas a serem mantidas
         cols = [
             'NO_REGIAO', 'SG_UF', 'NO_MUNICIPIO', 'CO_MUNICIPIO', 'TP_CATEGORIA_ADMINISTRATIVA',
             col_area, 'CO_CINE_AREA_GERAL', 'QT_MAT', 'QT_MAT_FEM', 'CO_IES'
         ]
-        for c in ['QT_ING', 'QT_CONC']:
+        for c in ['QT_ING', 'QT_CONC'] + CINE_COLS_DETALHE:
             if c in df.columns:
                 cols.append(c)
         
@@ -190,7 +372,13 @@ def load_cursos(ano):
                 df_clean[c] = df_clean[c].astype('category')
         for c in ['QT_MAT','QT_MAT_FEM','QT_ING','QT_CONC','TP_CATEGORIA_ADMINISTRATIVA','CO_MUNICIPIO','CO_CINE_AREA_GERAL']:
             if c in df_clean.columns:
-                df_clean[c] = pd.to_numeric(df_clean[c], errors='coerce')
+                df_clean[c] = pd.to_numeric(df_clean[c], errors='coerce', downcast='integer' if MEMORIA_MAX else None)
+        # Níveis CINE mais finos como categóricos compactos (códigos inteiros internos)
+        for _, col_cod, col_nome, largura in CINE_NIVEIS[:-1]:
+            if col_cod in df_clean.columns:
+                df_clean[col_cod] = _cine_codigo(df_clean[col_cod], largura)
+            if col_nome in df_clean.columns:
+                df_clean[col_nome] = df_clean[col_nome].astype('category')
         if not df_clean.empty:
             return df_clean
         legacy = load_legacy_cursos(ano)
@@ -199,6 +387,43 @@ def load_cursos(ano):
         # print(f"Erro ao carregar dados do ano {ano}: {e}")
         return pd.DataFrame()
 
+def _colunas_legado(colunas):
+    """Mapeia os nomes de colunas dos GRADUACAO_*.CSV (variam entre edições) para os nomes padronizados."""
+    achar = lambda nomes: next((c for c in colunas if c.upper() in nomes), None)
+    return {
+        'NO_REGIAO': achar(['NO_REGIAO']),
+        'SG_UF': achar(['SG_UF_CURSO','SG_UF']),
+        'CO_MUNICIPIO': achar(['CODMUNIC','CO_MUNICIPIO','CO_MUNICIPIO_CURSO']),
+        'AREA_GERAL': achar(['NO_AREA_CONHE','AREACURSO','NO_OCDE_AREA_GERAL','NO_CINE_AREA_GERAL']),
+        'CO_IES': achar(['CO_IES','CODIGO_IES','CO_IES_CURSO','MASCARA','ID_IES','CODIGO_INSTITUICAO']),
+        'FEM_DIURNO': achar(['QT_MAT_ATU_DIU_FEMI','QT_MAT_ATU_DIURNO_FEMI']),
+        'MASC_DIURNO': achar(['QT_MAT_ATU_DIU_MASC','QT_MAT_ATU_DIURNO_MASC']),
+        'FEM_NOTURNO': achar(['QT_MAT_ATU_NOT_FEMI','QT_MAT_ATU_NOTURNO_FEMI']),
+        'MASC_NOTURNO': achar(['QT_MAT_ATU_NOT_MASC','QT_MAT_ATU_NOTURNO_MASC']),
+    }
+
+def _preparar_legado(dfg, mapa, ano, arquivo):
+    """Colunas padronizadas e matrículas por sexo de um bloco de GRADUACAO_*.CSV, já validado."""
+    out = pd.DataFrame(index=dfg.index)
+    for c in ['NO_REGIAO', 'SG_UF', 'CO_MUNICIPIO', 'AREA_GERAL']:
+        out[c] = dfg[mapa[c]] if mapa[c] else np.nan
+    if mapa['CO_IES']:
+        out['CO_IES'] = dfg[mapa['CO_IES']]
+    # Sem fillna antes da validação: turnos todos ausentes aparecem como QT_AUSENTE
+    soma_turnos = lambda cs: pd.concat([pd.to_numeric(dfg[c], errors='coerce') for c in cs if c], axis=1).sum(axis=1, min_count=1) if any(cs) else pd.Series(np.nan, index=dfg.index)
+    out['QT_MAT_FEM'] = soma_turnos([mapa['FEM_DIURNO'], mapa['FEM_NOTURNO']])
+    out['QT_MAT_MASC'] = soma_turnos([mapa['MASC_DIURNO'], mapa['MASC_NOTURNO']])
+    out['QT_MAT'] = out['QT_MAT_FEM'] + out['QT_MAT_MASC']
+    manter = _validar_chunk(out, ano, arquivo)
+    for c in ['QT_MAT_FEM', 'QT_MAT_MASC']:
+        out[c] = out[c].fillna(0)
+    out['QT_MAT'] = out['QT_MAT_FEM'] + out['QT_MAT_MASC']
+    out['ANO'] = ano
+    if MEMORIA_MAX:
+        # Mesmo corte antecipado dos CURSOS_*.CSV: só regiões alvo e áreas STEM seguem
+        manter &= out['NO_REGIAO'].isin(REGIOES_ALVO) & _mascara_stem(out)
+    return out[manter]
+
 def load_legacy_cursos(ano):
     base = os.path.join(PATH_DADOS_DIR, f"microdados_censo_da_educacao_superior_{ano}")
     gpaths = glob.glob(os.path.join(base, '**', 'DADOS', 'GRADUACAO_*.CSV'), recursive=True)
@@ -206,43 +431,41 @@ def load_legacy_cursos(ano):
     if not gpaths:
         return pd.DataFrame()
     dfs = []
+    sums = {'QT_MAT': ('QT_MAT', 'sum'), 'QT_MAT_FEM': ('QT_MAT_FEM', 'sum'), 'QT_MAT_MASC': ('QT_MAT_MASC', 'sum')}
     for gp in gpaths:
-        try:
-            dfg = pd.read_csv(gp, sep='|', encoding='latin1', low_memory=False)
-        except Exception:
+        sep = None
+        for s in ['|', ';']:
             try:
-                dfg = pd.read_csv(gp, sep=';', encoding='latin1', low_memory=False)
+                cab = pd.read_csv(gp, sep=s, encoding='latin1', low_memory=False, nrows=0 if MEMORIA_MAX else None)
+                sep = s
+                break
             except Exception:
                 continue
-        cols_map = {}
-        cols_map['NO_REGIAO'] = next((c for c in dfg.columns if c.upper() == 'NO_REGIAO'), None)
-        uf_col = next((c for c in dfg.columns if c.upper() in ['SG_UF_CURSO','SG_UF']), None)
-        mun_code_col = next((c for c in dfg.columns if c.upper() in ['CODMUNIC','CO_MUNICIPIO','CO_MUNICIPIO_CURSO']), None)
-        area_col = next((c for c in dfg.columns if c.upper() in ['NO_AREA_CONHE','AREACURSO','NO_OCDE_AREA_GERAL','NO_CINE_AREA_GERAL']), None)
-        ies_id_col = next((c for c in dfg.columns if c.upper() in ['CO_IES','CODIGO_IES','CO_IES_CURSO','MASCARA','ID_IES','CODIGO_INSTITUICAO']), None)
-        f_diurno = next((c for c in dfg.columns if c.upper() in ['QT_MAT_ATU_DIU_FEMI','QT_MAT_ATU_DIURNO_FEMI']), None)
-        m_diurno = next((c for c in dfg.columns if c.upper() in ['QT_MAT_ATU_DIU_MASC','QT_MAT_ATU_DIURNO_MASC']), None)
-        f_not = next((c for c in dfg.columns if c.upper() in ['QT_MAT_ATU_NOT_FEMI','QT_MAT_ATU_NOTURNO_FEMI']), None)
-        m_not = next((c for c in dfg.columns if c.upper() in ['QT_MAT_ATU_NOT_MASC','QT_MAT_ATU_NOTURNO_MASC']), None)
-        dfg['NO_REGIAO'] = dfg[cols_map['NO_REGIAO']] if cols_map['NO_REGIAO'] else np.nan
-        dfg['SG_UF'] = dfg[uf_col] if uf_col else np.nan
-        dfg['CO_MUNICIPIO'] = dfg[mun_code_col] if mun_code_col else np.nan
-        dfg['AREA_GERAL'] = dfg[area_col] if area_col else np.nan
-        if ies_id_col:
-            dfg['CO_IES'] = dfg[ies_id_col]
-        fem = (pd.to_numeric(dfg[f_diurno], errors='coerce').fillna(0) if f_diurno else 0) + (pd.to_numeric(dfg[f_not], errors='coerce').fillna(0) if f_not else 0)
-        masc = (pd.to_numeric(dfg[m_diurno], errors='coerce').fillna(0) if m_diurno else 0) + (pd.to_numeric(dfg[m_not], errors='coerce').fillna(0) if m_not else 0)
-        dfg['QT_MAT_FEM'] = fem
-        dfg['QT_MAT_MASC'] = masc
-        dfg['QT_MAT'] = dfg['QT_MAT_FEM'] + dfg['QT_MAT_MASC']
-        dfg['ANO'] = ano
-        sel_cols = ['NO_REGIAO','SG_UF','CO_MUNICIPIO','AREA_GERAL','QT_MAT','QT_MAT_FEM','QT_MAT_MASC','ANO'] + (['CO_IES'] if 'CO_IES' in dfg.columns else [])
-        dfs.append(dfg[sel_cols])
+        if sep is None:
+            continue
+        mapa = _colunas_legado(cab.columns)
+        if not MEMORIA_MAX:
+            dfs.append(_preparar_legado(cab, mapa, ano, os.path.basename(gp)))
+            continue
+        # Com orçamento de memória: leitura em chunks só das colunas mapeadas, agregando a cada chunk
+        usecols = [c for c in mapa.values() if c]
+        dtypes = {mapa[c]: 'category' for c in ['NO_REGIAO', 'SG_UF', 'AREA_GERAL'] if mapa[c]}
+        chunk_size = args.chunk_size if args.chunk_size and args.chunk_size > 0 else _chunk_size_auto(gp, usecols, dtypes, sep=sep)
+        MEMORIA_CHUNKS[ano] = chunk_size
+        agg_df = None
+        for chunk in pd.read_csv(gp, sep=sep, encoding='latin1', low_memory=False, chunksize=chunk_size, usecols=usecols, dtype=dtypes):
+            parte = _preparar_legado(chunk, mapa, ano, os.path.basename(gp))
+            keys = ['NO_REGIAO','SG_UF','CO_MUNICIPIO','AREA_GERAL','ANO'] + (['CO_IES'] if 'CO_IES' in parte.columns else [])
+            grp = parte.groupby(keys, dropna=False, observed=True).agg(**sums).reset_index()
+            agg_df = grp if agg_df is None else pd.concat([agg_df, grp], ignore_index=True).groupby(keys, dropna=False, observed=True).agg(**sums).reset_index()
+        if agg_df is not None:
+            dfs.append(agg_df)
     df_leg = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
     if df_leg.empty:
         return df_leg
+    df_leg = df_leg[df_leg['NO_REGIAO'].isin(REGIOES_ALVO)]
     group_keys = ['NO_REGIAO','SG_UF','CO_MUNICIPIO','AREA_GERAL','ANO'] + (['CO_IES'] if 'CO_IES' in df_leg.columns else [])
-    df_leg = df_leg.groupby(group_keys).agg(QT_MAT=('QT_MAT','sum'), QT_MAT_FEM=('QT_MAT_FEM','sum'), QT_MAT_MASC=('QT_MAT_MASC','sum')).reset_index()
+    df_leg = df_leg.groupby(group_keys, dropna=False, observed=True).agg(QT_MAT=('QT_MAT','sum'), QT_MAT_FEM=('QT_MAT_FEM','sum'), QT_MAT_MASC=('QT_MAT_MASC','sum')).reset_index()
     dep_map = None
     if ipaths:
         try:
@@ -259,14 +482,24 @@ def load_legacy_cursos(ano):
     if dep_map is not None:
         dep_map['DEP'] = pd.to_numeric(dep_map['DEP'], errors='coerce')
         if 'CO_IES' in df_leg.columns and 'CO_IES' in dep_map.columns:
-            df_leg = df_leg.merge(dep_map[['CO_IES','DEP','SG_UF','CO_MUNICIPIO','NO_MUNICIPIO']], on='CO_IES', how='left')
+            ies_cols = [c for c in ['CO_IES','DEP','SG_UF','CO_MUNICIPIO','NO_MUNICIPIO'] if c in dep_map.columns]
+            df_leg = df_leg.merge(dep_map[ies_cols].drop_duplicates('CO_IES'), on='CO_IES', how='left', suffixes=('', '_IES'))
+            # UF e município do curso têm precedência; os da IES só preenchem lacunas
+            for c in ['SG_UF', 'CO_MUNICIPIO']:
+                if c + '_IES' in df_leg.columns:
+                    df_leg[c] = df_leg[c].fillna(df_leg.pop(c + '_IES'))
         else:
             df_leg = df_leg.merge(dep_map, on=['SG_UF','CO_MUNICIPIO'], how='left')
         df_leg['TIPO_IES'] = np.where(df_leg['DEP'].fillna(9).astype(int) <= 3, 'Pública', 'Privada')
+        # Mesma codificação (1–3 = pública) usada para TP_CATEGORIA_ADMINISTRATIVA nos CURSOS_*.CSV
+        df_leg['TP_CATEGORIA_ADMINISTRATIVA'] = df_leg['DEP']
     else:
         df_leg['TIPO_IES'] = np.nan
+        df_leg['TP_CATEGORIA_ADMINISTRATIVA'] = np.nan
     if 'NO_MUNICIPIO' not in df_leg.columns:
-        df_leg['NO_MUNICIPIO'] = df_leg['CO_MUNICIPIO'].astype(str)
+        # Códigos ausentes continuam sem município (não viram o nome 'nan')
+        cod = pd.to_numeric(df_leg['CO_MUNICIPIO'], errors='coerce').astype('Int64')
+        df_leg['NO_MUNICIPIO'] = cod.astype(str).where(cod.notna())
     return df_leg
 # --- 3. ENGENHARIA DE DADOS (FILTROS E CÁLCULOS) ---
 
@@ -368,7 +601,7 @@ def _scan_md5_by_year(base_dir):
             if os.path.basename(p).upper() in exp:
                 present.add(os.path.basename(p).upper())
         rows.append({'ANO': ano, 'ESPERADOS': len(exp), 'PRESENTES': len(present), 'AUSENTES': len(exp - present), 'ARQUIVOS_AUSENTES': ",".join(sorted(exp - present))})
-    df = pd.DataFrame(rows).sort_values('ANO')
+    df = pd.DataFrame(rows, columns=['ANO', 'ESPERADOS', 'PRESENTES', 'AUSENTES', 'ARQUIVOS_AUSENTES']).sort_values('ANO')
     return df
 
 LEGACY_YEARS = _collect_legacy_years(PATH_DADOS_DIR)
@@ -382,8 +615,23 @@ parser.add_argument("--cine-nomes", type=str)
 parser.add_argument("--chunk-size", type=int)
 parser.add_argument("--saida-dir", type=str)
 parser.add_argument("--municipios-top", type=int)
+parser.add_argument("--cine-niveis", type=str)
+parser.add_argument("--bootstrap", type=int)
+parser.add_argument("--ic-nivel", type=float)
+parser.add_argument("--bootstrap-jobs", type=int)
+parser.add_argument("--min-matriculas", type=int)
+parser.add_argument("--vizinhos", type=int)
+parser.add_argument("--permutacoes", type=int)
+parser.add_argument("--janela-movel", type=int)
+parser.add_argument("--qualidade-politica", type=str, choices=['manter', 'quarentena'])
+parser.add_argument("--qualidade-amostra", type=int)
+parser.add_argument("--memoria-max", type=str)
 args, _ = parser.parse_known_args()
 
+QUALIDADE_POLITICA = args.qualidade_politica or 'manter'
+MEMORIA_MAX = _parse_memoria(args.memoria_max) if args.memoria_max else None
+QUALIDADE_AMOSTRA = args.qualidade_amostra if isinstance(args.qualidade_amostra, int) and args.qualidade_amostra >= 0 else 20
+
 REGIOES_ALVO = ['Nordeste', 'Sudeste']
 if args.regioes:
     REGIOES_ALVO = [s.strip() for s in args.regioes.split(',') if s.strip()]
@@ -413,6 +661,13 @@ else:
     anos = anos_all
 
 N_CLUSTERS = args.clusters if isinstance(args.clusters, int) and args.clusters > 1 else 3
+N_BOOTSTRAP = args.bootstrap if isinstance(args.bootstrap, int) and args.bootstrap >= 0 else 1000
+IC_NIVEL = args.ic_nivel if args.ic_nivel and 0 < args.ic_nivel < 100 else 95.0
+BOOTSTRAP_JOBS = args.bootstrap_jobs if isinstance(args.bootstrap_jobs, int) and args.bootstrap_jobs > 1 else 1
+MIN_MATRICULAS = args.min_matriculas if isinstance(args.min_matriculas, int) and args.min_matriculas > 0 else 0
+K_VIZINHOS = args.vizinhos if isinstance(args.vizinhos, int) and args.vizinhos > 0 else 8
+N_PERMUTACOES = args.permutacoes if isinstance(args.permutacoes, int) and args.permutacoes > 0 else 999
+JANELA_MOVEL = args.janela_movel if isinstance(args.janela_movel, int) and args.janela_movel > 0 else 3
 CINE_CODES_SELECTED = []
 if args.cine:
     CINE_CODES_SELECTED = [c.strip().zfill(2) for c in args.cine.split(',') if c.strip()]
@@ -437,55 +692,15 @@ if args.cine_nomes:
                 c = '07'
         mapped.append(c)
     CINE_CODES_SELECTED = sorted(set(CINE_CODES_SELECTED) | {c for c in mapped if c is not None})
+CINE_NIVEIS_SELECTED = [n for n, _, _, _ in CINE_NIVEIS]
+if args.cine_niveis:
+    _pedidos = {unicodedata.normalize('NFD', t.strip().lower()).encode('ascii', 'ignore').decode() for t in args.cine_niveis.split(',') if t.strip()}
+    CINE_NIVEIS_SELECTED = [n for n in CINE_NIVEIS_SELECTED if n in _pedidos] or CINE_NIVEIS_SELECTED
 
-lista_dfs = []
-for ano in anos:
-    print(f"Processando {ano}...")
-    dfa = load_cursos(ano)
-    if not dfa.empty:
-        lista_dfs.append(dfa)
-df_geral = pd.concat(lista_dfs, ignore_index=True) if len(lista_dfs) > 0 else pd.DataFrame(columns=['ANO'])
-
-if df_geral.empty:
+if not anos:
     print("Nenhum dado carregado. Verifique os arquivos CSV.")
     exit()
 
-# Identificação STEM
-if 'CO_CINE_AREA_GERAL' in df_geral.columns:
-    codes = df_geral['CO_CINE_AREA_GERAL'].astype(str).str.zfill(2)
-    by_cine = codes.isin(CINE_STEM_CODES)
-    # Usa CINE como primário, fallback para palavras-chave
-    df_geral['IS_STEM'] = np.where(df_geral['CO_CINE_AREA_GERAL'].notna(), by_cine, df_geral['AREA_GERAL'].apply(identificar_stem))
-else:
-    df_geral['IS_STEM'] = df_geral['AREA_GERAL'].apply(identificar_stem)
-    
-df_stem = df_geral[df_geral['IS_STEM']].copy()
-
-if CINE_CODES_SELECTED and 'CO_CINE_AREA_GERAL' in df_stem.columns:
-    df_stem = df_stem[df_stem['CO_CINE_AREA_GERAL'].astype(str).str.zfill(2).isin(CINE_CODES_SELECTED)].copy()
-
-# Definição Pública vs Privada (1,2,3 = Pública)
-cat = pd.to_numeric(df_stem['TP_CATEGORIA_ADMINISTRATIVA'], errors='coerce')
-df_stem['TIPO_IES'] = np.where(cat.fillna(9).astype(int) <= 3, 'Pública', 'Privada')
-
-# Cálculo da Disparidade de Gênero
-df_stem['QT_MAT_MASC'] = df_stem['QT_MAT'] - df_stem['QT_MAT_FEM']
-
-# Agregação por Ano e Região
-resumo_anual = df_stem.groupby(['ANO', 'NO_REGIAO']).agg(
-    QT_MAT=('QT_MAT', 'sum'),
-    QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
-    QT_MAT_MASC=('QT_MAT_MASC', 'sum')
-).reset_index()
-
-# Cálculo das métricas de gênero
-resumo_anual['PCT_MULHERES'] = resumo_anual['QT_MAT_FEM'] / resumo_anual['QT_MAT'] * 100
-resumo_anual['PCT_HOMENS'] = resumo_anual['QT_MAT_MASC'] / resumo_anual['QT_MAT'] * 100
-# Índice de Paridade de Gênero (IPG): Mulheres / Homens. IPG = 1.0 é paridade.
-resumo_anual['IPG_STEM'] = np.where(resumo_anual['QT_MAT_MASC'] > 0, resumo_anual['QT_MAT_FEM'] / resumo_anual['QT_MAT_MASC'], np.nan)
-
-# --- 4. GERAÇÃO DOS GRÁFICOS E TABELAS ---
-
 BASE_OUT = os.path.abspath(args.saida_dir) if args.saida_dir else os.path.dirname(os.path.abspath(__file__))
 OUTPUT_DIR = os.path.join(BASE_OUT, 'Imagens_Geradas')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -530,11 +745,151 @@ def _save_json(obj, name):
             json.dump(obj, fh, ensure_ascii=False, indent=2)
     except Exception:
         pass
+
+def _unir_categorias(dfs):
+    """Alinha as categorias (ordenadas) de cada coluna categórica entre os anos; sem isso o concat vira object."""
+    for c in set().union(*(d.columns for d in dfs)):
+        cols = [d[c] for d in dfs if c in d.columns]
+        if not all(isinstance(col.dtype, pd.CategoricalDtype) for col in cols):
+            continue
+        cats = sorted(set().union(*(col.cat.categories for col in cols)), key=str)
+        for d in dfs:
+            if c in d.columns:
+                d[c] = d[c].cat.set_categories(cats)
+    return dfs
+
+lista_dfs = []
+for ano in anos:
+    print(f"Processando {ano}...")
+    dfa = load_cursos(ano)
+    if dfa.empty:
+        continue
+    lista_dfs.append(dfa)
+df_geral = pd.concat(_unir_categorias(lista_dfs), ignore_index=True) if len(lista_dfs) > 0 else pd.DataFrame(columns=['ANO'])
+del lista_dfs, dfa
+# Relatório de qualidade da carga gravado já aqui, antes das etapas de análise
+if QUALIDADE_CONTAGENS:
+    qualidade = pd.DataFrame(QUALIDADE_CONTAGENS).groupby(['ANO', 'ARQUIVO', 'REGRA'], sort=False).agg(
+        LINHAS=('LINHAS', 'sum'),
+        OCORRENCIAS=('OCORRENCIAS', 'sum')
+    ).reset_index().sort_values(['ANO', 'REGRA'])
+    qualidade['PCT_LINHAS'] = qualidade['OCORRENCIAS'] / qualidade['LINHAS'].where(qualidade['LINHAS'] > 0) * 100
+    qualidade['POLITICA'] = QUALIDADE_POLITICA
+    print(f"\n--- Qualidade dos dados na carga (política: {QUALIDADE_POLITICA}) ---")
+    print(_to_md(qualidade[qualidade['OCORRENCIAS'] > 0] if (qualidade['OCORRENCIAS'] > 0).any() else qualidade.head(0)))
+    _save_table(qualidade, "qualidade_dados_carga" + SFX)
+    if QUALIDADE_AMOSTRAS:
+        _save_table(pd.concat(QUALIDADE_AMOSTRAS, ignore_index=True), "qualidade_dados_amostras" + SFX)
+
+if df_geral.empty:
+    print("Nenhum dado carregado. Verifique os arquivos CSV.")
+    exit()
+
+# Identificação STEM (CINE como primário, fallback para palavras-chave)
+df_geral['IS_STEM'] = _mascara_stem(df_geral)
+if MEMORIA_MAX:
+    # As linhas já chegam filtradas por chunk; evita manter duas cópias da base
+    df_stem = df_geral if df_geral['IS_STEM'].all() else df_geral[df_geral['IS_STEM']]
+    del df_geral
+else:
+    df_stem = df_geral[df_geral['IS_STEM']].copy()
+
+if CINE_CODES_SELECTED and 'CO_CINE_AREA_GERAL' in df_stem.columns:
+    df_stem = df_stem[_cine_codigo(df_stem['CO_CINE_AREA_GERAL'], 2).isin(CINE_CODES_SELECTED)].copy()
+
+# Definição Pública vs Privada (1,2,3 = Pública)
+cat = pd.to_numeric(df_stem['TP_CATEGORIA_ADMINISTRATIVA'], errors='coerce')
+# Indexa um vetor de dois rótulos: a coluna guarda referências, sem criar um texto por linha
+df_stem['TIPO_IES'] = np.array(['Pública', 'Privada'], dtype=object)[(cat.fillna(9) > 3).to_numpy(dtype=np.int8)]
+
+# Cálculo da Disparidade de Gênero
+df_stem['QT_MAT_MASC'] = df_stem['QT_MAT'] - df_stem['QT_MAT_FEM']
+
+# Agregação por Ano e Região
+resumo_anual = df_stem.groupby(['ANO', 'NO_REGIAO'], observed=True).agg(
+    QT_MAT=('QT_MAT', 'sum'),
+    QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
+    QT_MAT_MASC=('QT_MAT_MASC', 'sum')
+).reset_index()
+
+# Cálculo das métricas de gênero
+resumo_anual['PCT_MULHERES'] = resumo_anual['QT_MAT_FEM'] / resumo_anual['QT_MAT'] * 100
+resumo_anual['PCT_HOMENS'] = resumo_anual['QT_MAT_MASC'] / resumo_anual['QT_MAT'] * 100
+# Índice de Paridade de Gênero (IPG): Mulheres / Homens. IPG = 1.0 é paridade.
+resumo_anual['IPG_STEM'] = np.where(resumo_anual['QT_MAT_MASC'] > 0, resumo_anual['QT_MAT_FEM'] / resumo_anual['QT_MAT_MASC'], np.nan)
+
+# Intervalos de confiança por bootstrap paramétrico (binomial sobre QT_MAT_FEM/QT_MAT)
+BOOT_BLOCO = 2_000_000  # elementos (grupos x réplicas) sorteados por bloco
+
+IC_COLS = ['PCT_IC_INF', 'PCT_IC_SUP', 'IPG_IC_INF', 'IPG_IC_SUP']
+
+def _bootstrap_ic(df, n_rep=None, nivel=None, jobs=None, seed=42):
+    """Acrescenta PCT_IC_INF/PCT_IC_SUP e IPG_IC_INF/IPG_IC_SUP (percentis das réplicas).
+
+    Cada grupo é reamostrado como Binomial(QT_MAT, QT_MAT_FEM/QT_MAT); todas as réplicas de um bloco
+    de grupos saem de um único sorteio matricial. Os grupos são sorteados na ordem das suas chaves
+    (colunas fora de QT_/PCT_/IPG_), então o IC de um grupo não depende da ordem das linhas da tabela.
+    Blocos independentes podem rodar em paralelo (--bootstrap-jobs); limites do IPG sem matrículas
+    masculinas ficam NaN, como no IPG_STEM. Sem réplicas ou sem linhas as colunas ficam NaN.
+    """
+    n_rep = N_BOOTSTRAP if n_rep is None else n_rep
+    nivel = IC_NIVEL if nivel is None else nivel
+    jobs = BOOTSTRAP_JOBS if jobs is None else jobs
+    if n_rep <= 0 or df.empty:
+        for c in IC_COLS:
+            df[c] = np.nan
+        return df
+    chaves = [c for c in df.columns if not c.startswith(('QT_', 'PCT_', 'IPG_'))]
+    ordem = np.arange(len(df))
+    if chaves:
+        # Códigos ordenados por coluna (NaN vira -1) e lexsort, com a primeira chave como a mais significativa
+        ordem = np.lexsort([pd.factorize(df[c], sort=True)[0] for c in reversed(chaves)])
+    n = pd.to_numeric(df['QT_MAT'], errors='coerce').fillna(0).clip(lower=0).round().to_numpy(dtype=np.int64)[ordem]
+    f = np.minimum(pd.to_numeric(df['QT_MAT_FEM'], errors='coerce').fillna(0).clip(lower=0).round().to_numpy(dtype=np.int64)[ordem], n)
+    p = np.divide(f, n, out=np.zeros(len(n)), where=n > 0)
+    q = [(100 - nivel) / 200, 1 - (100 - nivel) / 200]
+    blocos = np.array_split(np.arange(len(n)), max(1, int(np.ceil(len(n) * n_rep / BOOT_BLOCO))))
+    sementes = np.random.SeedSequence(seed).spawn(len(blocos))
+
+    def _bloco(ix, ss):
+        rng = np.random.default_rng(ss)
+        fem = rng.binomial(n[ix, None], p[ix, None], size=(len(ix), n_rep))
+        return np.quantile(fem, q, axis=1)
+
+    if jobs > 1 and len(blocos) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as ex:
+            res = list(ex.map(_bloco, blocos, sementes))
+    else:
+        res = [_bloco(ix, ss) for ix, ss in zip(blocos, sementes)]
+    # PCT e IPG são monótonos em QT_MAT_FEM para QT_MAT fixo: basta transformar os quantis das contagens
+    fem_ic = np.empty((2, len(n)))
+    fem_ic[:, ordem] = np.concatenate(res, axis=1)
+    n = n[np.argsort(ordem)]
+    masc_ic = n - fem_ic
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct_ic = np.where(n > 0, fem_ic / np.where(n > 0, n, 1) * 100, np.nan)
+        ipg_ic = np.where((n > 0) & (masc_ic > 0), fem_ic / np.where(masc_ic > 0, masc_ic, 1), np.nan)
+    df['PCT_IC_INF'], df['PCT_IC_SUP'] = pct_ic[0], pct_ic[1]
+    df['IPG_IC_INF'], df['IPG_IC_SUP'] = ipg_ic[0], ipg_ic[1]
+    return df
+
+resumo_anual = _bootstrap_ic(resumo_anual)
+
+# --- 4. GERAÇÃO DOS GRÁFICOS E TABELAS ---
+
 _save_json({
     'cine_codes': CINE_CODES_SELECTED if CINE_CODES_SELECTED else CINE_STEM_CODES,
     'anos': [anos[0], anos[-1]],
     'regioes': REGIOES_ALVO,
     'clusters': N_CLUSTERS,
+    'bootstrap': N_BOOTSTRAP,
+    'ic_nivel': IC_NIVEL,
+    'min_matriculas': MIN_MATRICULAS,
+    'vizinhos': K_VIZINHOS,
+    'permutacoes': N_PERMUTACOES,
+    'janela_movel': JANELA_MOVEL,
+    'qualidade_politica': QUALIDADE_POLITICA,
+    'memoria_max': args.memoria_max,
     'sufixo': SFX,
     'titulo_filtros': FILTER_STR
 }, "filtros_aplicados" + SFX)
@@ -575,7 +930,7 @@ plt.close()
 
 # GRÁFICO 2: Comparação Pública vs Privada (Foco no último ano) - PCT_MULHERES
 ano_ref = anos[-1]
-resumo_tipo = df_stem.groupby(['ANO', 'NO_REGIAO', 'TIPO_IES']).agg(
+resumo_tipo = df_stem.groupby(['ANO', 'NO_REGIAO', 'TIPO_IES'], observed=True).agg(
     QT_MAT=('QT_MAT', 'sum'),
     QT_MAT_FEM=('QT_MAT_FEM', 'sum')
 ).reset_index()
@@ -606,7 +961,7 @@ def _consistency_summary(df, group_cols):
     x = df.copy()
     x['ERR_IPG_NEG'] = x['IPG_STEM'] < 0
     x['ERR_PCT_OUT'] = (x['PCT_MULHERES'] < 0) | (x['PCT_MULHERES'] > 100)
-    agg = x.groupby(group_cols).agg(
+    agg = x.groupby(group_cols, observed=True).agg(
         REGISTROS=('IPG_STEM','size'),
         IPG_NEG=('ERR_IPG_NEG','sum'),
         PCT_FORA=('ERR_PCT_OUT','sum')
@@ -614,18 +969,19 @@ def _consistency_summary(df, group_cols):
     return agg
 
 print("\n--- Tabela de Evolução da Disparidade (IPG) ---")
-print(_to_md(resumo_anual[['ANO', 'NO_REGIAO', 'QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC', 'PCT_MULHERES', 'IPG_STEM']]))
-_save_table(resumo_anual[['ANO', 'NO_REGIAO', 'QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC', 'PCT_MULHERES', 'IPG_STEM']], f"tabela_evolucao_ipg_{anos[0]}_{ano_ref}{SFX}")
+print(_to_md(resumo_anual[['ANO', 'NO_REGIAO', 'QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS]))
+_save_table(resumo_anual[['ANO', 'NO_REGIAO', 'QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS], f"tabela_evolucao_ipg_{anos[0]}_{ano_ref}{SFX}")
 
 print("\n--- Classificação de Cursos STEM ---")
 print(_to_md(pd.DataFrame(CINE_STEM_AREAS.items(), columns=['Código CINE', 'Área de Estudo'])))
 _save_table(pd.DataFrame(CINE_STEM_AREAS.items(), columns=['Código CINE', 'Área de Estudo']), "classificacao_cine_stem" + SFX)
 
 # --- 5. Geração de Tabela de Disparidade por Área STEM (Último Ano) ---
-df_stem_area = df_stem[df_stem['ANO'] == ano_ref].copy()
-df_stem_area['AREA_CINE'] = df_stem_area['CO_CINE_AREA_GERAL'].astype(str).str.zfill(2).map(CINE_STEM_AREAS)
+# Só as colunas usadas; o rótulo da área sai das categorias do código, não de texto linha a linha
+df_stem_area = df_stem.loc[df_stem['ANO'] == ano_ref, [c for c in ['NO_REGIAO', 'CO_CINE_AREA_GERAL', 'QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC'] if c in df_stem.columns]]
+df_stem_area['AREA_CINE'] = _cine_codigo(df_stem_area['CO_CINE_AREA_GERAL'], 2).map(CINE_STEM_AREAS).astype(object) if 'CO_CINE_AREA_GERAL' in df_stem_area.columns else np.nan
 
-resumo_area = df_stem_area.groupby(['NO_REGIAO', 'AREA_CINE']).agg(
+resumo_area = df_stem_area.groupby(['NO_REGIAO', 'AREA_CINE'], observed=True).agg(
     QT_MAT=('QT_MAT', 'sum'),
     QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
     QT_MAT_MASC=('QT_MAT_MASC', 'sum')
@@ -633,35 +989,140 @@ resumo_area = df_stem_area.groupby(['NO_REGIAO', 'AREA_CINE']).agg(
 
 resumo_area['PCT_MULHERES'] = resumo_area['QT_MAT_FEM'] / resumo_area['QT_MAT'] * 100
 resumo_area['IPG_STEM'] = np.where(resumo_area['QT_MAT_MASC'] > 0, resumo_area['QT_MAT_FEM'] / resumo_area['QT_MAT_MASC'], np.nan)
+resumo_area = _bootstrap_ic(resumo_area)
 
 print(f"\n--- Tabela de Disparidade por Área STEM e Região ({ano_ref}) ---")
-print(_to_md(resumo_area[['NO_REGIAO', 'AREA_CINE', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']].sort_values(by=['NO_REGIAO', 'IPG_STEM'], ascending=[True, False])))
-_save_table(resumo_area[['NO_REGIAO', 'AREA_CINE', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']].sort_values(by=['NO_REGIAO', 'IPG_STEM'], ascending=[True, False]), f"tabela_disparidade_area_{ano_ref}{SFX}")
+print(_to_md(resumo_area[['NO_REGIAO', 'AREA_CINE', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS].sort_values(by=['NO_REGIAO', 'IPG_STEM'], ascending=[True, False])))
+_save_table(resumo_area[['NO_REGIAO', 'AREA_CINE', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS].sort_values(by=['NO_REGIAO', 'IPG_STEM'], ascending=[True, False]), f"tabela_disparidade_area_{ano_ref}{SFX}")
+
+# --- 5b. Drill-down CINE: rótulo → detalhada → específica → geral ---
+def _metricas_genero(df):
+    """Acrescenta PCT_MULHERES e IPG_STEM a partir de QT_MAT, QT_MAT_FEM e QT_MAT_MASC."""
+    df['PCT_MULHERES'] = df['QT_MAT_FEM'] / df['QT_MAT'].where(df['QT_MAT'] > 0) * 100
+    df['IPG_STEM'] = df['QT_MAT_FEM'] / df['QT_MAT_MASC'].where(df['QT_MAT_MASC'] > 0)
+    return df
+
+def _cine_chave(df):
+    """Código CINE mais fino disponível em cada linha (rótulo, senão detalhada, específica ou geral).
+
+    A combinação entre níveis é feita sobre os códigos inteiros das categorias; os textos só são
+    normalizados nos valores únicos de cada nível.
+    """
+    codigos = np.full(len(df), -1, dtype=np.int64)
+    rotulos = []
+    for _, col_cod, _, largura in CINE_NIVEIS:
+        if col_cod not in df.columns:
+            continue
+        cods, uniq = pd.factorize(df[col_cod])
+        if len(uniq) == 0:
+            continue
+        txt = _cine_codigo(pd.Series(np.asarray(uniq, dtype=object)), largura).astype(str)
+        codigos = np.where((codigos < 0) & (cods >= 0), cods + len(rotulos), codigos)
+        rotulos.extend(txt)
+    # Um mesmo texto pode aparecer em mais de um nível: reindexa para categorias únicas
+    remap, cats = pd.factorize(pd.Index(rotulos, dtype=object))
+    codigos = np.append(remap, -1)[codigos]
+    return pd.Series(pd.Categorical.from_codes(codigos, categories=cats), index=df.index)
+
+def _cine_hierarquia(df, chave):
+    """Índice pré-computado: uma linha por chave CINE com os códigos (e nomes) de todos os níveis acima.
+
+    Os códigos observados nos microdados têm precedência; níveis ausentes são derivados do prefixo
+    da chave (ex.: rótulo 0613C01 → detalhada 0613 → específica 061 → geral 06). Só a primeira linha
+    de cada chave é lida, então o trabalho com texto fica restrito às chaves distintas.
+    """
+    cods, pos = np.unique(chave.cat.codes.to_numpy(), return_index=True)
+    pos = pos[cods >= 0]
+    cols = [c for _, cod, nome, _ in CINE_NIVEIS for c in (cod, nome) if c in df.columns]
+    idx = df.iloc[pos][cols].copy()
+    idx.insert(0, 'CHAVE_CINE', chave.iloc[pos].to_numpy())
+    chave = idx['CHAVE_CINE'].astype(str)
+    for nivel, col_cod, col_nome, largura in CINE_NIVEIS:
+        if col_cod in idx.columns:
+            idx[col_cod] = _cine_codigo(idx[col_cod], largura).astype('string')
+        else:
+            idx[col_cod] = pd.Series(pd.NA, index=idx.index, dtype='string')
+        if largura:
+            prefixo = chave.str[:largura].where(chave.str.len() >= largura)
+            idx[col_cod] = idx[col_cod].fillna(prefixo.astype('string'))
+        else:
+            idx[col_cod] = idx[col_cod].fillna(chave.where(chave.str.len() > 4).astype('string'))
+        if col_nome not in idx.columns:
+            idx[col_nome] = np.nan
+    idx['NO_CINE_AREA_GERAL'] = idx['NO_CINE_AREA_GERAL'].fillna(idx['CO_CINE_AREA_GERAL'].map(CINE_STEM_AREAS))
+    return idx.set_index('CHAVE_CINE')
+
+def _agregar_cine_niveis(df, chaves, niveis):
+    """Agrupa uma única vez pela chave CINE mais fina e sobe a hierarquia sobre essa base reduzida.
+
+    Retorna {nível: DataFrame} com QT_MAT, QT_MAT_FEM, QT_MAT_MASC, PCT_MULHERES e IPG_STEM.
+    """
+    x = df[chaves + ['QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC']].copy()
+    x['CHAVE_CINE'] = _cine_chave(df)
+    base = x.groupby(chaves + ['CHAVE_CINE'], observed=True).agg(
+        QT_MAT=('QT_MAT', 'sum'),
+        QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
+        QT_MAT_MASC=('QT_MAT_MASC', 'sum')
+    ).reset_index()
+    hier = _cine_hierarquia(df, x['CHAVE_CINE'])
+    base = base.join(hier, on='CHAVE_CINE')
+    out = {}
+    for nivel, col_cod, col_nome, _ in CINE_NIVEIS:
+        if nivel not in niveis:
+            continue
+        sub = base.dropna(subset=[col_cod])
+        if sub.empty:
+            continue
+        res = sub.groupby(chaves + [col_cod], observed=True).agg(
+            QT_MAT=('QT_MAT', 'sum'),
+            QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
+            QT_MAT_MASC=('QT_MAT_MASC', 'sum')
+        ).reset_index()
+        nomes = hier.dropna(subset=[col_cod]).drop_duplicates(col_cod).set_index(col_cod)[col_nome]
+        if nomes.notna().any():
+            res.insert(len(chaves) + 1, col_nome, res[col_cod].map(nomes))
+        out[nivel] = _bootstrap_ic(_metricas_genero(res))
+    return out
+
+if any(c in df_stem.columns for c in CINE_COLS_DETALHE):
+    tabelas_cine = _agregar_cine_niveis(df_stem, ['ANO', 'NO_REGIAO'], CINE_NIVEIS_SELECTED)
+    for nivel, tab in tabelas_cine.items():
+        col_cod = next(cod for n, cod, _, _ in CINE_NIVEIS if n == nivel)
+        tab = tab.sort_values(['ANO', 'NO_REGIAO', col_cod])
+        print(f"\n--- IPG por nível CINE '{nivel}' e Região ({ano_ref}) ---")
+        print(_to_md(tab[tab['ANO'] == ano_ref].drop(columns=['ANO'])))
+        _save_table(tab, f"tabela_ipg_cine_{nivel}_{anos[0]}_{ano_ref}{SFX}")
 
 # Tabela 4: Comparação Pública vs Privada (Último Ano)
-resumo_tipo = df_stem.groupby(['ANO', 'NO_REGIAO', 'TIPO_IES']).agg(
+resumo_tipo = df_stem.groupby(['ANO', 'NO_REGIAO', 'TIPO_IES'], observed=True).agg(
     QT_MAT=('QT_MAT', 'sum'),
     QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
     QT_MAT_MASC=('QT_MAT_MASC', 'sum')
 ).reset_index()
 resumo_tipo['PCT_MULHERES'] = resumo_tipo['QT_MAT_FEM'] / resumo_tipo['QT_MAT'] * 100
 resumo_tipo['IPG_STEM'] = np.where(resumo_tipo['QT_MAT_MASC'] > 0, resumo_tipo['QT_MAT_FEM'] / resumo_tipo['QT_MAT_MASC'], np.nan)
+resumo_tipo = _bootstrap_ic(resumo_tipo)
 
 print(f"\n--- Tabela de Disparidade por Tipo de IES e Região ({ano_ref}) ---")
-print(_to_md(resumo_tipo[resumo_tipo['ANO'] == ano_ref][['NO_REGIAO', 'TIPO_IES', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']].sort_values(by=['NO_REGIAO', 'TIPO_IES'])))
-_save_table(resumo_tipo[resumo_tipo['ANO'] == ano_ref][['NO_REGIAO', 'TIPO_IES', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']].sort_values(by=['NO_REGIAO', 'TIPO_IES']), f"tabela_disparidade_tipo_ies_{ano_ref}{SFX}")
+print(_to_md(resumo_tipo[resumo_tipo['ANO'] == ano_ref][['NO_REGIAO', 'TIPO_IES', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS].sort_values(by=['NO_REGIAO', 'TIPO_IES'])))
+_save_table(resumo_tipo[resumo_tipo['ANO'] == ano_ref][['NO_REGIAO', 'TIPO_IES', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS].sort_values(by=['NO_REGIAO', 'TIPO_IES']), f"tabela_disparidade_tipo_ies_{ano_ref}{SFX}")
+
+def _norm_mun(x):
+    s = unicodedata.normalize('NFD', str(x))
+    s = ''.join(ch for ch in s if unicodedata.category(ch) != 'Mn')
+    return s.upper().strip()
 
-df_mun = df_stem[df_stem['ANO'] == ano_ref].copy()
 cols_needed = ['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC']
-df_mun = df_mun[cols_needed]
-df_mun = df_mun.groupby(['NO_MUNICIPIO', 'NO_REGIAO']).agg(
+df_mun = df_stem.loc[df_stem['ANO'] == ano_ref, cols_needed]
+df_mun = df_mun.groupby(['NO_MUNICIPIO', 'NO_REGIAO'], observed=True).agg(
     QT_MAT=('QT_MAT', 'sum'),
     QT_MAT_FEM=('QT_MAT_FEM', 'sum'),
     QT_MAT_MASC=('QT_MAT_MASC', 'sum')
-).reset_index()
+).reset_index().astype({'NO_MUNICIPIO': object, 'NO_REGIAO': object})
 df_mun['IPG_STEM'] = np.where(df_mun['QT_MAT_MASC'] > 0, df_mun['QT_MAT_FEM'] / df_mun['QT_MAT_MASC'], np.nan)
 df_mun['PCT_MULHERES'] = df_mun['QT_MAT_FEM'] / df_mun['QT_MAT'] * 100
 df_mun = df_mun.replace([np.inf, -np.inf], np.nan).dropna(subset=['IPG_STEM', 'QT_MAT'])
+df_mun = _bootstrap_ic(df_mun)
 if len(df_mun) >= 3:
     feats = df_mun[['IPG_STEM', 'QT_MAT', 'PCT_MULHERES']].values
     scaler = StandardScaler()
@@ -689,22 +1150,20 @@ if len(df_mun) >= 3:
     plt.close()
     
     print(f"\n--- Clusterização por Município ({ano_ref}) ---")
-    print(_to_md(df_mun[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM', 'CLUSTER']].sort_values(['NO_REGIAO','CLUSTER','NO_MUNICIPIO'])))
-    _save_table(df_mun[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM', 'CLUSTER']].sort_values(['NO_REGIAO','CLUSTER','NO_MUNICIPIO']), f"tabela_cluster_municipio_{ano_ref}{SFX}")
+    print(_to_md(df_mun[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM', 'CLUSTER'] + IC_COLS].sort_values(['NO_REGIAO','CLUSTER','NO_MUNICIPIO'])))
+    _save_table(df_mun[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM', 'CLUSTER'] + IC_COLS].sort_values(['NO_REGIAO','CLUSTER','NO_MUNICIPIO']), f"tabela_cluster_municipio_{ano_ref}{SFX}")
     top_n = args.municipios_top if isinstance(args.municipios_top, int) and args.municipios_top > 0 else 10
-    top_ipg = df_mun.sort_values('IPG_STEM', ascending=False).head(top_n)
+    # Municípios com poucas matrículas têm IPG instável; --min-matriculas os exclui dos rankings
+    df_rank = df_mun[df_mun['QT_MAT'] >= MIN_MATRICULAS]
+    top_ipg = df_rank.sort_values('IPG_STEM', ascending=False).head(top_n)
     print("\n--- Top municípios por IPG ---")
-    print(_to_md(top_ipg[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']]))
-    _save_table(top_ipg[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']], f"top_municipios_ipg_{ano_ref}{SFX}")
-    top_pct = df_mun.sort_values('PCT_MULHERES', ascending=False).head(top_n)
+    print(_to_md(top_ipg[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS]))
+    _save_table(top_ipg[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS], f"top_municipios_ipg_{ano_ref}{SFX}")
+    top_pct = df_rank.sort_values('PCT_MULHERES', ascending=False).head(top_n)
     print("\n--- Top municípios por % Mulheres ---")
-    print(_to_md(top_pct[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']]))
-    _save_table(top_pct[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM']], f"top_municipios_pct_{ano_ref}{SFX}")
+    print(_to_md(top_pct[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS]))
+    _save_table(top_pct[['NO_MUNICIPIO', 'NO_REGIAO', 'QT_MAT', 'PCT_MULHERES', 'IPG_STEM'] + IC_COLS], f"top_municipios_pct_{ano_ref}{SFX}")
     
-    def _norm_mun(x):
-        s = unicodedata.normalize('NFD', str(x))
-        s = ''.join(ch for ch in s if unicodedata.category(ch) != 'Mn')
-        return s.upper().strip()
     coords_path = os.path.join(PATH_DADOS_DIR, 'municipios_coords.csv')
     COORDS = {}
     if os.path.exists(coords_path):
@@ -765,6 +1224,323 @@ if len(df_mun) >= 3:
         plt.close()
 else:
     print("\nAmostra municipal insuficiente para clusterização (mínimo de 3 registros).")
+# --- 6. ANÁLISE ESPACIAL: GRAFO k-NN E I DE MORAN (GLOBAL E LOCAL) ---
+CACHE_DIR = os.path.join(BASE_OUT, 'Cache_Espacial')
+PERM_BLOCO = 1_000_000  # elementos (municípios x permutações) por bloco nos testes de Moran
+
+def _chave_municipio(df, chaves):
+    """Chave de junção com as coordenadas: CO_MUNICIPIO, ou nome normalizado (com a UF quando houver)."""
+    if chaves == ['CO_MUNICIPIO']:
+        return pd.to_numeric(df['CO_MUNICIPIO'], errors='coerce')
+    chave = df['NO_MUNICIPIO'].astype(object).map(_norm_mun)
+    if 'SG_UF' in chaves:
+        chave = chave + '|' + df['SG_UF'].astype(object).map(_norm_mun)
+    return chave
+
+def _carregar_coords():
+    """Lê municipios_coords.csv; a chave é CO_MUNICIPIO se existir, senão nome normalizado + SG_UF.
+
+    Sem código nem UF, nomes repetidos com coordenadas distintas (ex.: Bom Jesus) são ambíguos e ficam
+    de fora da análise espacial, com aviso.
+    """
+    path = os.path.join(PATH_DADOS_DIR, 'municipios_coords.csv')
+    vazio = pd.DataFrame(columns=['CHAVE', 'LON', 'LAT'])
+    if not os.path.exists(path):
+        return vazio, None
+    try:
+        dcm = pd.read_csv(path, sep=';', encoding='latin1', low_memory=False)
+    except Exception:
+        return vazio, None
+    if 'CO_MUNICIPIO' in dcm.columns:
+        chaves = ['CO_MUNICIPIO']
+    elif 'NO_MUNICIPIO' in dcm.columns and 'SG_UF' in dcm.columns:
+        chaves = ['NO_MUNICIPIO', 'SG_UF']
+    elif 'NO_MUNICIPIO' in dcm.columns:
+        chaves = ['NO_MUNICIPIO']
+    else:
+        return vazio, None
+    dcm['CHAVE'] = _chave_municipio(dcm, chaves)
+    dcm['LON'] = pd.to_numeric(dcm['LON'], errors='coerce')
+    dcm['LAT'] = pd.to_numeric(dcm['LAT'], errors='coerce')
+    dcm = dcm.dropna(subset=['CHAVE', 'LON', 'LAT']).drop_duplicates(['CHAVE', 'LON', 'LAT'])
+    if chaves == ['NO_MUNICIPIO']:
+        ambiguos = dcm['CHAVE'].duplicated(keep=False)
+        if ambiguos.any():
+            print(f"Aviso: municipios_coords.csv sem CO_MUNICIPIO/SG_UF; {dcm.loc[ambiguos, 'CHAVE'].nunique()} nome(s) com coordenadas distintas ignorado(s) na análise espacial.")
+            dcm = dcm[~ambiguos]
+    return dcm.drop_duplicates('CHAVE')[['CHAVE', 'LON', 'LAT']], chaves
+
+def _grafo_knn(lonlat, k):
+    """Matriz esparsa (CSR) de pesos k-NN padronizada por linha, com cache em disco.
+
+    Os vizinhos são buscados numa KD-tree sobre coordenadas cartesianas na esfera unitária,
+    o que preserva a ordem das distâncias geodésicas.
+    """
+    lon, lat = np.radians(lonlat[:, 0]), np.radians(lonlat[:, 1])
+    xyz = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    n = len(xyz)
+    k = min(k, n - 1)
+    chave = hashlib.sha1(np.ascontiguousarray(xyz).tobytes() + str(k).encode()).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, f"knn_k{k}_{chave}.npz")
+    if os.path.exists(path):
+        try:
+            return sparse.load_npz(path).tocsr()
+        except Exception:
+            pass
+    _, ind = cKDTree(xyz).query(xyz, k=k + 1)
+    # Remove o próprio ponto (nem sempre na 1ª coluna quando há coordenadas repetidas)
+    proprio = ind == np.arange(n)[:, None]
+    ind = np.take_along_axis(ind, np.argsort(proprio, axis=1, kind='stable'), axis=1)[:, :k]
+    W = sparse.csr_matrix((np.full(n * k, 1.0 / k), (np.repeat(np.arange(n), k), ind.ravel())), shape=(n, n))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        sparse.save_npz(path, W)
+    except Exception:
+        pass
+    return W
+
+def _moran(x, W, n_perm, seed=42):
+    """I de Moran global e local (LISA) com testes de permutação vetorizados.
+
+    O global permuta x inteiro (matriz n x permutações, um único produto esparso). O local usa
+    permutação condicional: para cada município, k valores sorteados entre os demais formam o lag.
+    As permutações correm em blocos de até PERM_BLOCO elementos, na mesma sequência de sorteios.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    z = x - x.mean()
+    m2 = (z @ z) / n
+    lag = W @ z
+    I = (z @ lag) / (z @ z)
+    passo = max(1, PERM_BLOCO // n)
+    I_perm = np.empty(n_perm)
+    for ini in range(0, n_perm, passo):
+        b = min(passo, n_perm - ini)
+        zp = rng.permuted(np.broadcast_to(z[:, None], (n, b)), axis=0)
+        I_perm[ini:ini + b] = np.einsum('ij,ij->j', zp, W @ zp) / (z @ z)
+    if I >= I_perm.mean():
+        p_glob = ((I_perm >= I).sum() + 1) / (n_perm + 1)
+    else:
+        p_glob = ((I_perm <= I).sum() + 1) / (n_perm + 1)
+    sd = I_perm.std()
+    glob = {'MORAN_I': I, 'E_I': -1.0 / (n - 1), 'Z_SIM': (I - I_perm.mean()) / sd if sd > 0 else np.nan, 'P_VALOR': p_glob}
+
+    k = int(np.diff(W.indptr).max())
+    lisa = z * lag / m2
+    quad = np.select([(z > 0) & (lag > 0), (z < 0) & (lag < 0), (z > 0) & (lag < 0), (z < 0) & (lag > 0)], ['AA', 'BB', 'AB', 'BA'], 'NS')
+    if n - 1 <= k:
+        # Todos os demais já são vizinhos: a permutação condicional sorteia sempre o mesmo conjunto
+        local = pd.DataFrame({'LISA_I': lisa, 'LAG_IPG': lag + x.mean(), 'P_VALOR': np.nan, 'QUADRANTE': 'NS'})
+        return glob, local
+    # Tolerância relativa à maior LISA possível do município: empates (a menos de arredondamento) contam como extremos
+    eps = 1e-9 * np.abs(z) * np.abs(z).max() / m2 + 1e-12
+    maiores = np.zeros(n, dtype=np.int64)
+    for ini in range(0, n_perm, passo):
+        b = min(passo, n_perm - ini)
+        # Um sorteio de k índices distintos entre os n-1 demais por permutação, comum a todos os municípios.
+        # Para o município i o índice r aponta para r se r < i e para r+1 caso contrário (pula o próprio i),
+        # logo a soma dos vizinhos sorteados é base + soma acumulada de (z[r] - z[r+1]) para r < i.
+        r = rng.random((b, n - 1)).argpartition(k - 1, axis=1)[:, :k]
+        base = z[r + 1].sum(axis=1)
+        ajuste = np.zeros((b, n))
+        ajuste[np.arange(b)[:, None], r + 1] = z[r] - z[r + 1]
+        lisa_perm = z * (base[:, None] + np.cumsum(ajuste, axis=1)) / k / m2
+        maiores += np.where(lisa >= 0, lisa_perm >= lisa - eps, lisa_perm <= lisa + eps).sum(axis=0)
+    p_loc = (maiores + 1) / (n_perm + 1)
+    local = pd.DataFrame({'LISA_I': lisa, 'LAG_IPG': lag + x.mean(), 'P_VALOR': p_loc,
+                          'QUADRANTE': np.where(p_loc < 0.05, quad, 'NS')})
+    return glob, local
+    # Um sorteio de k índices distintos entre os n-1 demais por permutação, comum a todos os municípios.
+    # Para o município i o índice r aponta para r se r < i e para r+1 caso contrário (pula o próprio i),
+    # logo a soma dos vizinhos sorteados é base + soma acumulada de (z[r] - z[r+1]) para r < i.
+    r = rng.random((n_perm, n - 1)).argpartition(k - 1, axis=1)[:, :k]
+    base = z[r + 1].sum(axis=1)
+    ajuste = np.zeros((n_perm, n))
+    ajuste[np.arange(n_perm)[:, None], r + 1] = z[r] - z[r + 1]
+    lisa_perm = z * (base[:, None] + np.cumsum(ajuste, axis=1)) / k / m2
+    # Tolerância relativa: empates (a menos de arredondamento) contam como extremos
+    eps = 1e-9 * np.maximum(np.abs(lisa), np.abs(lisa_perm).max(axis=0, initial=0.0)) + 1e-12
+    maiores = np.where(lisa >= 0, lisa_perm >= lisa - eps, lisa_perm <= lisa + eps).sum(axis=0)
+    p_loc = (maiores + 1) / (n_perm + 1)
+    local = pd.DataFrame({'LISA_I': lisa, 'LAG_IPG': lag + x.mean(), 'P_VALOR': p_loc,
+                          'QUADRANTE': np.where(p_loc < 0.05, quad, 'NS')})
+    return glob, local
+
+coords_esp, chaves_coords = _carregar_coords()
+if not coords_esp.empty and 'NO_MUNICIPIO' in df_stem.columns and all(c in df_stem.columns for c in chaves_coords):
+    aggs = {'NO_REGIAO': ('NO_REGIAO', 'first'), 'QT_MAT': ('QT_MAT', 'sum'), 'QT_MAT_FEM': ('QT_MAT_FEM', 'sum'), 'QT_MAT_MASC': ('QT_MAT_MASC', 'sum')}
+    for c in ['NO_MUNICIPIO', 'SG_UF']:
+        if c in df_stem.columns and c not in chaves_coords:
+            aggs[c] = (c, 'first')
+    mun_ano = df_stem.groupby(['ANO'] + chaves_coords, observed=True).agg(**aggs).reset_index()
+    mun_ano['IPG_STEM'] = mun_ano['QT_MAT_FEM'] / mun_ano['QT_MAT_MASC'].where(mun_ano['QT_MAT_MASC'] > 0)
+    mun_ano['CHAVE'] = _chave_municipio(mun_ano, chaves_coords)
+    if chaves_coords == ['NO_MUNICIPIO'] and 'SG_UF' in df_stem.columns:
+        # Só o nome não distingue homônimos de UFs diferentes: esses municípios ficam de fora
+        n_ufs = df_stem.groupby('NO_MUNICIPIO', observed=True)['SG_UF'].nunique()
+        homonimos = set(n_ufs.index[n_ufs > 1])
+        if homonimos:
+            print(f"Aviso: {len(homonimos)} nome(s) de município presente(s) em mais de uma UF ignorado(s) na análise espacial (coordenadas sem CO_MUNICIPIO/SG_UF).")
+            mun_ano = mun_ano[~mun_ano['NO_MUNICIPIO'].isin(homonimos)]
+    mun_ano = mun_ano.dropna(subset=['IPG_STEM']).merge(coords_esp, on='CHAVE', how='inner')
+    moran_rows, lisa_parts = [], []
+    for ano_e, d in mun_ano.groupby('ANO'):
+        d = d.sort_values('CHAVE').reset_index(drop=True)
+        if len(d) < 3 or d['IPG_STEM'].std() == 0:
+            continue
+        W = _grafo_knn(d[['LON', 'LAT']].to_numpy(dtype=float), K_VIZINHOS)
+        moran_glob, local = _moran(d['IPG_STEM'].to_numpy(dtype=float), W, N_PERMUTACOES)
+        moran_rows.append({'ANO': ano_e, 'N_MUNICIPIOS': len(d), 'K_VIZINHOS': int(W.getnnz(axis=1).max()), **moran_glob})
+        lisa_parts.append(pd.concat([d[[c for c in ['ANO', 'NO_MUNICIPIO', 'SG_UF', 'NO_REGIAO', 'LON', 'LAT', 'QT_MAT', 'IPG_STEM'] if c in d.columns]], local], axis=1))
+    if moran_rows:
+        moran_global = pd.DataFrame(moran_rows)
+        lisa_mun = pd.concat(lisa_parts, ignore_index=True)
+        print("\n--- I de Moran global do IPG municipal ---")
+        print(_to_md(moran_global))
+        _save_table(moran_global, f"tabela_moran_global_{anos[0]}_{ano_ref}{SFX}")
+        _save_table(lisa_mun, f"tabela_lisa_municipio_{anos[0]}_{ano_ref}{SFX}")
+        dl = lisa_mun[lisa_mun['ANO'] == ano_ref]
+        if not dl.empty:
+            print(f"\n--- Clusters LISA por quadrante ({ano_ref}) ---")
+            print(_to_md(dl.groupby(['NO_REGIAO', 'QUADRANTE'], observed=True).size().reset_index(name='MUNICIPIOS')))
+            plt.figure(figsize=(10, 8))
+            cores_lisa = {'AA': '#d62728', 'BB': '#1f77b4', 'AB': '#ff9896', 'BA': '#aec7e8', 'NS': '#c7c7c7'}
+            for quad, sub in dl.groupby('QUADRANTE'):
+                plt.scatter(sub['LON'], sub['LAT'], c=cores_lisa.get(quad, '#c7c7c7'), s=25, alpha=0.85, label=quad)
+            plt.title(f"Clusters LISA do IPG em STEM por município ({ano_ref})\n" + FILTER_STR)
+            plt.xlabel('Longitude')
+            plt.ylabel('Latitude')
+            plt.legend(title='Quadrante (p<0,05)')
+            plt.grid(True, alpha=0.3)
+            plt.tight_layout()
+            plt.savefig(os.path.join(OUTPUT_DIR, f"mapa_lisa_municipio_stem_{ano_ref}" + SFX + ".png"), dpi=150)
+            plt.close()
+# --- 7. TENDÊNCIAS: VARIAÇÃO ANUAL, MÉDIA MÓVEL, INCLINAÇÃO E PONTO DE MUDANÇA ---
+def _matriz_grupos_anos(cubo, col_grupo, anos_eixo):
+    """Pivot vetorizado do cubo para matrizes grupos x anos (NaN onde o grupo não tem dados)."""
+    g_cod, grupos = pd.factorize(cubo[col_grupo])
+    t_cod = np.searchsorted(anos_eixo, cubo['ANO'].to_numpy())
+    mats = {}
+    for c in ['QT_MAT', 'QT_MAT_FEM', 'QT_MAT_MASC']:
+        m = np.full((len(grupos), len(anos_eixo)), np.nan)
+        m[g_cod, t_cod] = 0
+        np.add.at(m, (g_cod, t_cod), cubo[c].to_numpy(dtype=float))
+        mats[c] = m
+    return grupos, mats
+
+def _somas_acumuladas(y):
+    """Somas acumuladas (com zero inicial) de contagem, y e y² ignorando NaN, ao longo dos anos."""
+    ok = ~np.isnan(y)
+    y0 = np.where(ok, y, 0.0)
+    pad = lambda a: np.concatenate([np.zeros((a.shape[0], 1)), np.cumsum(a, axis=1)], axis=1)
+    return pad(ok.astype(float)), pad(y0), pad(y0 ** 2)
+
+def _tendencias(y, anos_eixo, janela):
+    """Métricas de tendência de todas as séries (linhas de y) de uma vez.
+
+    Retorna delta anual, média móvel, inclinação OLS por ano e o ponto de mudança de média
+    (divisão em dois segmentos com menor soma de quadrados, ao menos 2 anos de cada lado).
+    """
+    G, T = y.shape
+    n_c, s_c, q_c = _somas_acumuladas(y)
+    delta = np.full_like(y, np.nan)
+    delta[:, 1:] = y[:, 1:] - y[:, :-1]
+    ini = np.maximum(np.arange(1, T + 1) - janela, 0)
+    fim = np.arange(1, T + 1)
+    n_w = n_c[:, fim] - n_c[:, ini]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        media = np.where(~np.isnan(y) & (n_w > 0), (s_c[:, fim] - s_c[:, ini]) / n_w, np.nan)
+        t = np.asarray(anos_eixo, dtype=float) - anos_eixo[0]
+        ok = ~np.isnan(y)
+        y0 = np.where(ok, y, 0.0)
+        n = ok.sum(axis=1)
+        sx, sy = (ok * t).sum(axis=1), y0.sum(axis=1)
+        sxx, sxy = (ok * t ** 2).sum(axis=1), (y0 * t).sum(axis=1)
+        den = n * sxx - sx ** 2
+        incl = np.where((n >= 2) & (den > 0), (n * sxy - sx * sy) / np.where(den > 0, den, 1), np.nan)
+        # SSE dos segmentos [0, k) e [k, T) para todo k, a partir das somas acumuladas
+        nl, sl, ql = n_c[:, 1:T], s_c[:, 1:T], q_c[:, 1:T]
+        nr, sr, qr = n_c[:, [T]] - nl, s_c[:, [T]] - sl, q_c[:, [T]] - ql
+        sse = (ql - sl ** 2 / nl) + (qr - sr ** 2 / nr)
+        sse = np.where((nl >= 2) & (nr >= 2), sse, np.inf)
+        sse_total = q_c[:, T] - s_c[:, T] ** 2 / n_c[:, T]
+    k = np.argmin(sse, axis=1) if T > 1 else np.zeros(G, dtype=int)
+    valido = np.isfinite(sse[np.arange(G), k]) if T > 1 else np.zeros(G, dtype=bool)
+    rows = np.arange(G)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        antes = s_c[rows, k + 1] / n_c[rows, k + 1]
+        depois = (s_c[:, T] - s_c[rows, k + 1]) / (n_c[:, T] - n_c[rows, k + 1])
+        reducao = np.where(sse_total > 0, 1 - sse[rows, k] / sse_total, 0.0)
+    mudanca = {
+        'ANO_MUDANCA': np.where(valido, np.asarray(anos_eixo)[np.minimum(k + 1, T - 1)], np.nan),
+        'MEDIA_ANTES': np.where(valido, antes, np.nan),
+        'MEDIA_DEPOIS': np.where(valido, depois, np.nan),
+        'REDUCAO_SSE': np.where(valido, reducao, np.nan),
+    }
+    return delta, media, incl, n, mudanca
+
+if 'ANO' in df_stem.columns and df_stem['ANO'].nunique() >= 2:
+    anos_eixo = np.array(sorted(df_stem['ANO'].dropna().unique()))
+    col_mun = 'CO_MUNICIPIO' if 'CO_MUNICIPIO' in df_stem.columns and df_stem['CO_MUNICIPIO'].notna().any() else 'NO_MUNICIPIO'
+    nomes_mun = None
+    if col_mun == 'CO_MUNICIPIO' and 'NO_MUNICIPIO' in df_stem.columns:
+        nomes_mun = df_stem.dropna(subset=['CO_MUNICIPIO']).drop_duplicates('CO_MUNICIPIO').set_index('CO_MUNICIPIO')['NO_MUNICIPIO']
+    niveis_tend = [('regiao', 'NO_REGIAO'), ('uf', 'SG_UF'), ('municipio', col_mun)]
+    tend_anuais, tend_resumo = [], []
+    for nivel, col in niveis_tend:
+        if col not in df_stem.columns:
+            continue
+        # Cubo próprio por nível: linha sem município (ex.: EAD) ainda conta para a região e a UF
+        aggs = {'QT_MAT': ('QT_MAT', 'sum'), 'QT_MAT_FEM': ('QT_MAT_FEM', 'sum'), 'QT_MAT_MASC': ('QT_MAT_MASC', 'sum')}
+        if col != 'NO_REGIAO':
+            aggs['NO_REGIAO'] = ('NO_REGIAO', 'first')
+        cubo = df_stem.groupby([col, 'ANO'], observed=True).agg(**aggs).reset_index()
+        if cubo.empty:
+            continue
+        grupos, mats = _matriz_grupos_anos(cubo, col, anos_eixo)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ipg = np.where(mats['QT_MAT_MASC'] > 0, mats['QT_MAT_FEM'] / mats['QT_MAT_MASC'], np.nan)
+            pct = np.where(mats['QT_MAT'] > 0, mats['QT_MAT_FEM'] / mats['QT_MAT'] * 100, np.nan)
+        d_ipg, mm_ipg, incl_ipg, n_anos, mud = _tendencias(ipg, anos_eixo, JANELA_MOVEL)
+        d_pct, mm_pct, incl_pct, _, _ = _tendencias(pct, anos_eixo, JANELA_MOVEL)
+        G, T = ipg.shape
+        rotulo = pd.Index(grupos).astype(str)
+        if nivel == 'municipio' and nomes_mun is not None:
+            rotulo = pd.Index(grupos).map(nomes_mun).astype(str)
+        regiao = cubo.drop_duplicates(col).set_index(col)['NO_REGIAO'].reindex(grupos).to_numpy() if col != 'NO_REGIAO' else np.asarray(grupos)
+        anual = pd.DataFrame({
+            'NIVEL': nivel,
+            'GRUPO': np.repeat(np.asarray(grupos), T),
+            'NOME': np.repeat(rotulo.to_numpy(), T),
+            'NO_REGIAO': np.repeat(regiao, T),
+            'ANO': np.tile(anos_eixo, G),
+            'QT_MAT': mats['QT_MAT'].ravel(),
+            'PCT_MULHERES': pct.ravel(),
+            'IPG_STEM': ipg.ravel(),
+            'DELTA_PCT': d_pct.ravel(),
+            'DELTA_IPG': d_ipg.ravel(),
+            f'MEDIA_MOVEL_PCT_{JANELA_MOVEL}': mm_pct.ravel(),
+            f'MEDIA_MOVEL_IPG_{JANELA_MOVEL}': mm_ipg.ravel(),
+        })
+        tend_anuais.append(anual.dropna(subset=['QT_MAT']))
+        tend_resumo.append(pd.DataFrame({
+            'NIVEL': nivel,
+            'GRUPO': np.asarray(grupos),
+            'NOME': rotulo.to_numpy(),
+            'NO_REGIAO': regiao,
+            'N_ANOS': n_anos,
+            'INCLINACAO_IPG_ANO': incl_ipg,
+            'INCLINACAO_PCT_ANO': incl_pct,
+            **{k + '_IPG': v for k, v in mud.items()},
+        }))
+    if tend_resumo:
+        tabela_tendencias = pd.concat(tend_resumo, ignore_index=True)
+        tabela_tendencias_anuais = pd.concat(tend_anuais, ignore_index=True)
+        print(f"\n--- Tendências do IPG por região e UF ({anos_eixo[0]}–{anos_eixo[-1]}) ---")
+        print(_to_md(tabela_tendencias[tabela_tendencias['NIVEL'] != 'municipio'].drop(columns=['GRUPO'])))
+        _save_table(tabela_tendencias, f"tabela_tendencias_{anos[0]}_{ano_ref}{SFX}")
+        _save_table(tabela_tendencias_anuais, f"tabela_tendencias_anuais_{anos[0]}_{ano_ref}{SFX}")
+
 md5_df = _scan_md5_by_year(PATH_DADOS_DIR)
 if not md5_df.empty:
     print("\n--- Completude de arquivos por ano (MD5) ---")
@@ -774,3 +1550,14 @@ cons_reg = _consistency_summary(resumo_anual, ['ANO','NO_REGIAO'])
 print("\n--- Resumo de Consistência (IPG e % mulheres) ---")
 print(_to_md(cons_reg.sort_values(['ANO','NO_REGIAO'])))
 _save_table(cons_reg.sort_values(['ANO','NO_REGIAO']), "consistencia_genero" + SFX)
+
+pico = _rss_pico()
+print(f"\nPico de memória (RSS): {pico / 2**20:.0f} MB" + (f" | orçamento: {MEMORIA_MAX / 2**20:.0f} MB" if MEMORIA_MAX else ""))
+if MEMORIA_MAX and pico > MEMORIA_MAX:
+    print("Aviso: pico acima do orçamento; reduza --chunk-size, o intervalo de anos ou aumente --memoria-max.")
+_save_json({
+    'memoria_max_mb': round(MEMORIA_MAX / 2**20, 1) if MEMORIA_MAX else None,
+    'pico_rss_mb': round(pico / 2**20, 1) if pico else None,
+    'dentro_do_orcamento': bool(pico <= MEMORIA_MAX) if MEMORIA_MAX and pico else None,
+    'chunk_por_ano': {str(k): v for k, v in MEMORIA_CHUNKS.items()}
+}, "memoria_execucao" + SFX)